@@ -4,6 +4,11 @@ use std::{
 };
 
 fn main() {
+    // Builds run in a persistent workspace so make sure a changed export name is
+    // picked up instead of reusing the previously generated entrypoint.
+    println!("cargo:rerun-if-changed=build.rs");
+    println!("cargo:rerun-if-env-changed=ECHIDNA_SHARED_ENTRYPOINT");
+
     if std::env::var_os("CARGO_FEATURE_USER").is_none() {
         return;
     }
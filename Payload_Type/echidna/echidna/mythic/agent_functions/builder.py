@@ -1,11 +1,12 @@
 import asyncio
+import collections
+import functools
 import json
 import os
 import pathlib
-import sys
 import tempfile
 import traceback
-from shutil import copytree
+from shutil import copy2, copytree, rmtree
 from mythic_container.PayloadBuilder import (
     PayloadType,
     SupportedOS,
@@ -17,6 +18,107 @@ from mythic_container.PayloadBuilder import (
 
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements
 
+# Directory holding the persistent build workspace for each target
+WORKSPACE_ROOT = pathlib.Path("/opt/echidna-ws")
+
+# Directory holding any prebuilt dependencies for each target
+DEPS_ROOT = pathlib.Path("/opt")
+
+# Locks serializing builds which share a workspace
+_workspace_locks = collections.defaultdict(asyncio.Lock)
+
+
+def _max_parallel_builds() -> int:
+    """Get the number of cargo builds allowed to run at the same time"""
+    try:
+        value = int(os.environ.get("ECHIDNA_MAX_PARALLEL_BUILDS", "1"))
+    except ValueError:
+        return 1
+
+    return value if value > 0 else 1
+
+
+# Maximum number of cargo builds allowed to run at the same time
+MAX_PARALLEL_BUILDS = _max_parallel_builds()
+_build_semaphore = asyncio.Semaphore(MAX_PARALLEL_BUILDS)
+
+# Number of jobs cargo runs for a build. The cores this container may run on are
+# split across the builds allowed to run at the same time
+CARGO_BUILD_JOBS = max(1, len(os.sched_getaffinity(0)) // MAX_PARALLEL_BUILDS)
+
+
+def _build_paths_for(
+    target_os: str, static: bool
+) -> tuple[pathlib.Path, pathlib.Path]:
+    """Get the persistent build workspace for a target and its prebuilt dependencies"""
+    deps_suffix = "_static" if static else ""
+    name = f"{target_os}{deps_suffix}"
+    return WORKSPACE_ROOT / name, DEPS_ROOT / name
+
+
+def _fast_copy(src, dst):
+    """Copy a file unless the destination already has the same size and mtime"""
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return copy2(src, dst)
+
+    src_stat = os.stat(src)
+    if (
+        src_stat.st_size == dst_stat.st_size
+        and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+    ):
+        return dst
+
+    return copy2(src, dst)
+
+
+def _seed_workspace(deps_path: pathlib.Path, target_dir: pathlib.Path):
+    """Seed a new workspace with any prebuilt dependencies if they exist"""
+    # The target directory only exists once a seed completed or cargo created it
+    if target_dir.exists():
+        return
+
+    # Copy into a sibling directory and move it into place once complete so an
+    # interrupted seed never leaves a partial target directory behind
+    staging_dir = target_dir.with_name(f"{target_dir.name}.seed")
+    rmtree(staging_dir, ignore_errors=True)
+
+    try:
+        copytree(deps_path, staging_dir)
+    except FileNotFoundError:
+        # There are no prebuilt dependencies
+        rmtree(staging_dir, ignore_errors=True)
+        return
+    except BaseException:
+        rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    os.rename(staging_dir, target_dir)
+
+
+@functools.lru_cache(maxsize=32)
+def _compute_feature_args(
+    build_shared: bool, onload: bool, custom_export: bool
+) -> tuple[str, ...]:
+    """Get the cargo arguments selecting the package and features to build"""
+    if not build_shared:
+        return ()
+
+    if onload:
+        return ("-p", "echidna_shared", "--features", "onload")
+
+    if custom_export:
+        return ("-p", "echidna_shared", "--features", "user")
+
+    return ("-p", "echidna_shared")
+
+
+def _read_build_output(output) -> bytes:
+    """Read the build output captured in a temporary file"""
+    output.seek(0)
+    return output.read()
+
 
 # Class defining information about the Echidna rootkit payload
 class Echidna(PayloadType):
@@ -70,7 +172,7 @@ class Echidna(PayloadType):
             parameter_type=BuildParameterType.String,
             description="Working hours for the agent (use 24 hour time)",
             default_value="00:00-23:59",
-            verifier_regex=r"^[0-2][0-9]:[0-5][0-9]-[0-2][0-9]:[0-5][0-9]",
+            verifier_regex=r"^([01][0-9]|2[0-3]):[0-5][0-9]-([01][0-9]|2[0-3]):[0-5][0-9]$",
             required=True,
         ),
         # Add a build option for static linking
@@ -121,21 +223,21 @@ class Echidna(PayloadType):
         resp = BuildResponse(status=BuildStatus.Error)
 
         try:
-            # Make a temporary directory for building the implant
-            agent_build_path = tempfile.TemporaryDirectory(suffix=self.uuid)
-
-            # Copy the implant code to the temporary directory
-            copytree(self.agent_code_path, agent_build_path.name, dirs_exist_ok=True)
-
             # Get the C2 profile information
             c2 = self.c2info[0]
             profile = c2.get_c2profile()["name"]
+            c2_params = c2.get_parameters_dict()
             if profile not in self.c2_profiles:
                 resp.build_message = "Invalid C2 profile name specified"
                 return resp
 
+            # Read every build parameter once instead of searching the parameter
+            # list on each lookup
+            build_params = {bp.name: bp.value for bp in self.build_parameters}
+            static = build_params["static"]
+
             # Get the architecture from the build parameter
-            if self.get_parameter("architecture") == "x64":
+            if build_params["architecture"] == "x64":
                 arch = "x86_64"
             else:
                 arch = "i686"
@@ -145,7 +247,7 @@ class Echidna(PayloadType):
 
             # Check for static linking (Linux only)
             abi = "gnu"
-            if self.get_parameter("static"):
+            if static:
                 rustflags.append("-C target-feature=+crt-static")
                 abi = "musl"
 
@@ -159,108 +261,74 @@ class Echidna(PayloadType):
             target_os = f"{arch}-unknown-linux-{abi}"
 
             # Combine the C2 parameters with the build parameters
-            c2_params = c2.get_parameters_dict()
             c2_params["UUID"] = self.uuid
 
             # Basic agent configuration
-            c2_params["daemonize"] = str(self.get_parameter("daemonize"))
-            c2_params["connection_retries"] = self.get_parameter("connection_retries")
-            c2_params["working_hours"] = self.get_parameter("working_hours")
+            c2_params["daemonize"] = str(build_params["daemonize"])
+            c2_params["connection_retries"] = build_params["connection_retries"]
+            c2_params["working_hours"] = build_params["working_hours"]
            
-            # Start formulating the command to build the agent
-            command = "env "
+            # Start formulating the environment used to build the agent
+            env = dict(os.environ)
 
             # Manually specify the C compiler for 32 bit Linux builds.
             if arch == "i686":
-                command += "CC_i686-unknown-linux-gnu=clang "
+                env["CC_i686-unknown-linux-gnu"] = "clang"
 
             # Set up openssl environment variables
-            openssl_env = "OPENSSL_STATIC=yes "
+            env["OPENSSL_STATIC"] = "yes"
             if arch == "x64":
-                openssl_env += "OPENSSL_LIB_DIR=/usr/lib64 "
+                env["OPENSSL_LIB_DIR"] = "/usr/lib64"
             else:
-                openssl_env += "OPENSSL_LIB_DIR=/usr/lib "
+                env["OPENSSL_LIB_DIR"] = "/usr/lib"
 
-            openssl_env += "OPENSSL_INCLUDE_DIR=/usr/include "
-            command += openssl_env
+            env["OPENSSL_INCLUDE_DIR"] = "/usr/include"
+
+            # Limit the number of jobs used by cargo unless explicitly configured
+            env.setdefault("CARGO_BUILD_JOBS", str(CARGO_BUILD_JOBS))
 
             # Add any rustflags if they exist
             if rustflags:
-                rustflags_str = " ".join(rustflags)
-                command += f'RUSTFLAGS="{rustflags_str}" '
-
-            # Loop through each C2/build parameter creating environment variable
-            # key/values for each option
-            for key, val in c2_params.items():
-                if isinstance(val, str):
-                    command += f"{key}='{val}' "
-                else:
-                    v = json.dumps(val)
-                    command += f"{key}='{v}' "
+                env["RUSTFLAGS"] = " ".join(rustflags)
+
+            # Create an environment variable for each C2/build parameter. Values
+            # which are not strings are passed as compact JSON
+            env.update(
+                {
+                    key: (
+                        val
+                        if isinstance(val, str)
+                        else json.dumps(val, separators=(",", ":"))
+                    )
+                    for key, val in c2_params.items()
+                }
+            )
 
-            features = []
-            build_shared = self.get_parameter("output").startswith("shared library")
+            build_shared = build_params["output"].startswith("shared library")
+            onload = False
+            custom_export = False
 
             # Configuration for the shared library output
             if build_shared:
-                export_name = self.get_parameter("shared_export")
-                onload = self.get_parameter("shared_config") == "run on load"
-
-                if onload:
-                    features.append("onload")
-                elif export_name != "entrypoint":
-                    features.append("user")
-                    command += f"ECHIDNA_SHARED_ENTRYPOINT='{export_name}' "
-
-            # Finish off the cargo command used for building the agent
-            command += f"cargo build --target {target_os} --release"
-
-            if build_shared:
-                command += " -p echidna_shared"
-
-            if len(features) > 0:
-                command += f" --features {','.join(features)}"
-
-            # Copy any prebuilt dependencies if they exist
-            deps_suffix = "_static" if self.get_parameter("static") else ""
-            deps_path = f"/opt/{target_os}{deps_suffix}"
-            if os.path.exists(deps_path):
-                copytree(
-                    f"{deps_path}",
-                    f"{agent_build_path.name}/target",
-                    dirs_exist_ok=True,
-                )
-
-            # Set the build stdout to the build command invocation
-            resp.build_message = str(command)
-
-            # Run the cargo command which builds the agent
-            proc = await asyncio.create_subprocess_shell(
-                command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                cwd=agent_build_path.name,
-            )
-
-            # Grab stdout/stderr
-            stdout, stderr = await proc.communicate()
-
-            # Check if the build command returned an error and send that error to Mythic
-            if proc.returncode != 0:
-                resp.set_build_stdout(stdout.decode())
-                resp.set_build_stderr(stderr.decode())
-                raise Exception("Failed to build payload. Check Build Errors")
-
-            # Copy any dependencies that were compiled
-            built_path = f"{agent_build_path.name}/target"
-            if os.path.exists(built_path):
-                copytree(f"{built_path}", f"{deps_path}", dirs_exist_ok=True)
-
-            # Check if there is anything on stdout/stderr and forward to Mythic
-            if stdout:
-                resp.set_build_stdout(f"{command}\n\n{stdout.decode()}")
-            if stderr:
-                resp.set_build_stderr(stderr.decode())
+                export_name = build_params["shared_export"]
+                onload = build_params["shared_config"] == "run on load"
+                custom_export = not onload and export_name != "entrypoint"
+
+                if custom_export:
+                    env["ECHIDNA_SHARED_ENTRYPOINT"] = export_name
+
+            # Formulate the cargo command used for building the agent. This is run
+            # directly without a shell so parameter values need no quoting
+            cargo_args = [
+                "cargo",
+                "build",
+                "--target",
+                target_os,
+                "--release",
+                *_compute_feature_args(build_shared, onload, custom_export),
+            ]
+
+            command = " ".join(cargo_args)
 
             target_name = ""
 
@@ -272,11 +340,70 @@ class Echidna(PayloadType):
                 # Set the payload output to the built executable
                 target_name = "echidna"
 
-            payload_path = (
-                f"{agent_build_path.name}/target/{target_os}/release/{target_name}"
-            )
-            with open(payload_path, "rb") as f:
-                resp.payload = f.read()
+            # Set the build stdout to the build command invocation
+            resp.build_message = str(command)
+
+            workspace, deps_path = _build_paths_for(target_os, static)
+            target_dir = workspace / "target"
+
+            # Builds for the same target share a workspace so only one may run in it
+            # at a time
+            async with _workspace_locks[workspace]:
+                # Sync the implant code into the workspace and seed it with any
+                # prebuilt dependencies. Files which are unchanged since the last
+                # build are skipped so cargo can reuse its artifacts. The copies run
+                # in worker threads so they do not block other builds
+                await asyncio.gather(
+                    asyncio.to_thread(
+                        copytree,
+                        self.agent_code_path,
+                        workspace,
+                        dirs_exist_ok=True,
+                        copy_function=_fast_copy,
+                    ),
+                    asyncio.to_thread(_seed_workspace, deps_path, target_dir),
+                )
+
+                # Run the cargo command which builds the agent. Concurrent builds
+                # are limited so they do not compete for the same cores
+                async with _build_semaphore:
+                    # The build output goes straight to temporary files rather than
+                    # being drained through the event loop
+                    with (
+                        tempfile.TemporaryFile() as stdout_file,
+                        tempfile.TemporaryFile() as stderr_file,
+                    ):
+                        proc = await asyncio.create_subprocess_exec(
+                            *cargo_args,
+                            env=env,
+                            stdout=stdout_file,
+                            stderr=stderr_file,
+                            cwd=workspace,
+                        )
+                        await proc.wait()
+
+                        # Grab stdout/stderr
+                        stdout, stderr = await asyncio.gather(
+                            asyncio.to_thread(_read_build_output, stdout_file),
+                            asyncio.to_thread(_read_build_output, stderr_file),
+                        )
+
+                # Check if the build command returned an error and send that error to Mythic
+                if proc.returncode != 0:
+                    resp.set_build_stdout(stdout.decode())
+                    resp.set_build_stderr(stderr.decode())
+                    raise Exception("Failed to build payload. Check Build Errors")
+
+                # Check if there is anything on stdout/stderr and forward to Mythic
+                if stdout:
+                    resp.set_build_stdout(f"{command}\n\n{stdout.decode()}")
+                if stderr:
+                    resp.set_build_stderr(stderr.decode())
+
+                # Read the payload before releasing the workspace since the next
+                # build for this target will overwrite it
+                payload_path = target_dir / target_os / "release" / target_name
+                resp.payload = await asyncio.to_thread(payload_path.read_bytes)
 
             # Notify Mythic that the build was successful
             resp.set_build_message("Successfully built Echidna rootkit agent.")
@@ -286,9 +413,6 @@ class Echidna(PayloadType):
 
         except Exception as e:
             # Return the python exception to the Mythic build message
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            resp.build_stderr += f"Error building payload: {e} traceback: " + repr(
-                traceback.format_exception(exc_type, exc_value, exc_traceback)
-            )
+            resp.build_stderr += f"Error building payload: {e}\n{traceback.format_exc()}"
 
         return resp
\ No newline at end of file
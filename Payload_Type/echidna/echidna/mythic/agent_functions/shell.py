@@ -1,5 +1,4 @@
 from mythic_container.MythicCommandBase import *
-import json
 from mythic_container.MythicRPC import *
 
 
@@ -38,7 +37,6 @@ class ShellCommand(CommandBase):
             CommandName="shell"
         )
         taskData.args.add_arg("command", taskData.args.command_line)
-        print(response)
         return response
 
     async def process_response(self, task: PTTaskMessageAllData, response: any) -> PTTaskProcessResponseMessageResponse:
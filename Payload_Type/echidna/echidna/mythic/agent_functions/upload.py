@@ -1,8 +1,37 @@
 from mythic_container.MythicCommandBase import *
-import json
 from mythic_container.MythicRPC import *
-import sys
-import re
+import time
+
+# Number of seconds a file search result is reused before asking Mythic again
+FILE_META_TTL = 60
+
+# Successful file search results keyed by callback ID and agent file ID. Mythic
+# scopes file searches to the requesting task, so results are only reused by
+# tasks on the same callback (such as deploy and its upload subtask)
+_file_meta_cache = {}
+
+
+async def get_file_meta(
+    task_id: int, callback_id: int, agent_file_id: str
+) -> MythicRPCFileSearchMessageResponse:
+    """Search Mythic for an uploaded file, reusing a recent result from the same callback"""
+    now = time.monotonic()
+    cache_key = (callback_id, agent_file_id)
+    cached = _file_meta_cache.get(cache_key)
+    if cached is not None and now - cached[0] < FILE_META_TTL:
+        return cached[1]
+
+    file_resp = await SendMythicRPCFileSearch(
+        MythicRPCFileSearchMessage(TaskID=task_id, AgentFileID=agent_file_id)
+    )
+    if file_resp.Success:
+        # Drop expired entries so the cache does not grow without bound
+        for key in [k for k, (ts, _) in _file_meta_cache.items() if now - ts >= FILE_META_TTL]:
+            del _file_meta_cache[key]
+        _file_meta_cache[cache_key] = (now, file_resp)
+
+    return file_resp
+
 
 class UploadArguments(TaskArguments):
 
@@ -38,9 +67,12 @@ class UploadArguments(TaskArguments):
         remote_path = self.get_arg("remote_path")
         if remote_path != "" and remote_path is not None:
             remote_path = remote_path.strip()
-            if remote_path[0] == '"' and remote_path[-1] == '"':
-                remote_path = remote_path[1:-1]
-            elif remote_path[0] == "'" and remote_path[-1] == "'":
+            # Strip a matching pair of surrounding quotes
+            if (
+                len(remote_path) >= 2
+                and remote_path[0] == remote_path[-1]
+                and remote_path[0] in ('"', "'")
+            ):
                 remote_path = remote_path[1:-1]
             self.add_arg("remote_path", remote_path)
 
@@ -64,10 +96,8 @@ class UploadCommand(CommandBase):
             TaskID=taskData.Task.ID,
             Success=True,
         )
-        file_resp = await SendMythicRPCFileSearch(
-            MythicRPCFileSearchMessage(
-                TaskID=taskData.Task.ID, AgentFileID=taskData.args.get_arg("file")
-            )
+        file_resp = await get_file_meta(
+            taskData.Task.ID, taskData.Task.CallbackID, taskData.args.get_arg("file")
         )
         if file_resp.Success:
             original_file_name = file_resp.Files[0].Filename